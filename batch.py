@@ -0,0 +1,296 @@
+import random
+from statistics import NormalDist
+
+import numpy as np
+
+from combat import histogram_hits
+from combat import MAX_ROUNDS
+from combat import SELF_HITS
+from schedule import next_alive
+from schedule import turn_sequence
+from streams import as_generator
+from streams import RngStream
+from targeting import target_ranking
+from unit import roll_pool
+from unit import side_ids
+
+
+#
+# Classes
+#
+
+
+class BatchResult:
+
+    def __init__(self, units, trials, wins, draws, survivals):
+        self.units = units
+        self.trials = trials
+        self.wins = wins
+        self.draws = draws
+        self.survivals = survivals
+
+    def win_rates(self):
+        return self.wins / self.trials
+
+    def draw_rate(self):
+        return self.draws / self.trials
+
+    def survival_rates(self):
+        return self.survivals / self.trials
+
+    def __add__(self, other):
+        return self.__class__(
+            self.units,
+            self.trials + other.trials,
+            self.wins + other.wins,
+            self.draws + other.draws,
+            self.survivals + other.survivals,
+        )
+
+    def win_intervals(self, confidence=0.95):
+        # Wilson score intervals, which stay sensible for rates near 0 or 1
+        z = NormalDist().inv_cdf((1 + confidence) / 2)
+        n = self.trials
+        p = self.win_rates()
+        center = (p + z**2/(2*n)) / (1 + z**2/n)
+        half = z*np.sqrt(p*(1 - p)/n + z**2/(4*n**2)) / (1 + z**2/n)
+        return (center - half, center + half)
+
+    def is_settled(self, width, confidence=0.95):
+        # Every win rate is pinned down to `width`, or one side is clearly
+        # ahead of all the others.  Teammates share their side's wins, so
+        # sides are compared through their first unit.
+        (lo, hi) = self.win_intervals(confidence)
+        if (hi - lo).max() <= width:
+            return True
+        sides = side_ids(u.team for u in self.units)
+        (_, first) = np.unique(sides, return_index=True)
+        leader = int(np.argmax(self.wins[first]))
+        rivals = np.delete(hi[first], leader)
+        # A lone side has no one to be ahead of
+        return len(rivals) == 0 or bool(lo[first][leader] > rivals.max())
+
+    def __repr__(self):
+        f_wins = ", ".join(
+            f"{u}={w:.3f}" for (u, w) in zip(self.units, self.win_rates())
+        )
+        return (
+            f"<BatchResult trials={self.trials} wins=[{f_wins}] "
+            f"draws={self.draw_rate():.3f}>"
+        )
+
+
+#
+# Helpers
+#
+
+
+def _select_targets(alive, ranking, attackers, sides):
+    # Units are never their own enemy, since they share their own side
+    eligible = (
+        alive[:, ranking]
+        & (sides[ranking][None, :] != sides[attackers][:, None])
+    )
+    found = eligible.any(axis=1)
+    return (ranking[eligible.argmax(axis=1)], found)
+
+
+def _next_scheduled(alive, sequence, cursor):
+    # Like `schedule.next_alive`, but walking a precomputed turn sequence
+    # (see `schedule.turn_sequence`) and returning indices into it
+    cursor = cursor.copy()
+    pending = np.flatnonzero(alive.any(axis=1))
+    while True:
+        pending = pending[cursor[pending] < len(sequence)]
+        pending = pending[~alive[pending, sequence[cursor[pending]]]]
+        if len(pending) == 0:
+            break
+        cursor[pending] += 1
+    found = alive.any(axis=1) & (cursor < len(sequence))
+    return (cursor, found)
+
+
+def _roll(rng, pool, shift):
+    histograms = roll_pool(rng, pool, size=len(shift))
+    return (histogram_hits(histograms, shift), histograms[:, SELF_HITS])
+
+
+def _apply_volleys(rng, absorbed, rows, attackers, defenders, pools, shift):
+    for a in np.unique(attackers):
+        sel = attackers == a
+        (hits, self_hits) = _roll(rng, pools[a], shift[sel])
+        absorbed[rows[sel], a] += self_hits
+        absorbed[rows[sel], defenders[sel]] += hits
+
+
+#
+# Main functions
+#
+
+
+def resume_seed(seed, done):
+    # Seed for the battles after the first `done` of a run, so topping up
+    # stored tallies never replays the battles they already hold.  RNG
+    # objects can't be rewound to a known point, so only seeds will do.
+    if isinstance(seed, RngStream):
+        seed = seed.seed_sequence
+    if isinstance(seed, np.random.SeedSequence):
+        return np.random.SeedSequence(
+            seed.entropy,
+            spawn_key=seed.spawn_key + (done,),
+        )
+    if isinstance(seed, (np.random.Generator, random.Random)):
+        raise TypeError(
+            f"Resumable runs need a seed or SeedSequence, not {seed!r}"
+        )
+    return np.random.SeedSequence(seed, spawn_key=(done,))
+
+
+def tally_outcomes(units, alive):
+    # Results from final alive flags, one row per battle.  A side wins when
+    # it is the only one with survivors, and every unit on it is credited;
+    # in a free-for-all that's the last unit standing.
+    alive = np.atleast_2d(alive)
+    sides = side_ids(u.team for u in units)
+    side_alive = np.zeros((len(alive), len(set(sides))), dtype=bool)
+    for (i, side) in enumerate(sides):
+        side_alive[:, side] |= alive[:, i]
+    decided = side_alive.sum(axis=1) == 1
+    return BatchResult(
+        units,
+        len(alive),
+        wins=(side_alive[:, sides] & decided[:, None]).sum(axis=0),
+        draws=int((~decided).sum()),
+        survivals=alive.sum(axis=0),
+    )
+
+
+def simulate(initiative, trials, rng=None, schedule=None):
+    # `schedule` is a `schedule` policy for the cannon phase; by default
+    # units take turns round-robin
+    rng = as_generator(rng)
+    sequence = None
+    if schedule is not None:
+        sequence = np.array(
+            turn_sequence(initiative, schedule, MAX_ROUNDS),
+            dtype=int,
+        )
+    units = list(initiative.one_round())
+    n = len(units)
+
+    hull = np.array([u.stats["hull_tank"] for u in units])
+    targeting = np.array([u.stats["targeting"] for u in units])
+    mitigation = np.array([u.stats["mitigation"] for u in units])
+    missile_pools = [u.missile_pool for u in units]
+    cannon_pools = [u.cannon_pool for u in units]
+    missile_ranking = target_ranking(
+        hull,
+        [len(u.missile_dice) for u in units],
+    )
+    cannon_ranking = target_ranking(
+        hull,
+        [len(u.cannon_dice) for u in units],
+    )
+
+    sides = side_ids(u.team for u in units)
+    absorbed = np.tile([u.absorbed_hits for u in units], (trials, 1))
+
+    # Missile phase: one volley per living unit, in initiative order.  Missile
+    # self-hits are never absorbed.
+    for attacker in range(n):
+        rows = np.flatnonzero(absorbed[:, attacker] <= hull[attacker])
+        attackers = np.full(len(rows), attacker)
+        (defenders, found) = _select_targets(
+            absorbed[rows] <= hull,
+            missile_ranking,
+            attackers,
+            sides,
+        )
+        (rows, defenders) = (rows[found], defenders[found])
+        (hits, _) = _roll(
+            rng,
+            missile_pools[attacker],
+            targeting[attacker] - mitigation[defenders],
+        )
+        absorbed[rows, defenders] += hits
+
+    # Cannon phase: living units take turns until one is left, everyone is
+    # dead, or MAX_ROUNDS turns have been taken.  Cursors are initiative
+    # positions round-robin, or indices into the schedule's turn sequence.
+    cursor = np.zeros(trials, dtype=int)
+    rows = np.arange(trials)
+    for _ in range(MAX_ROUNDS):
+        alive = absorbed[rows] <= hull
+        if sequence is None:
+            (attackers, found) = next_alive(alive, cursor[rows])
+            (rows, attackers, alive) = (
+                rows[found],
+                attackers[found],
+                alive[found],
+            )
+            next_cursor = attackers + 1
+        else:
+            (turns, found) = _next_scheduled(alive, sequence, cursor[rows])
+            (rows, turns, alive) = (rows[found], turns[found], alive[found])
+            attackers = sequence[turns]
+            next_cursor = turns + 1
+
+        (defenders, found) = _select_targets(
+            alive,
+            cannon_ranking,
+            attackers,
+            sides,
+        )
+        (rows, attackers, defenders, next_cursor) = (
+            rows[found],
+            attackers[found],
+            defenders[found],
+            next_cursor[found],
+        )
+        if len(rows) == 0:
+            break
+
+        _apply_volleys(
+            rng,
+            absorbed,
+            rows,
+            attackers,
+            defenders,
+            cannon_pools,
+            targeting[attackers] - mitigation[defenders],
+        )
+        cursor[rows] = next_cursor
+
+    return tally_outcomes(units, absorbed <= hull)
+
+
+def simulate_until(
+    initiative,
+    width,
+    confidence=0.95,
+    chunk=250,
+    max_trials=100_000,
+    rng=None,
+    cache=None,
+):
+    # Simulates in chunks until the result is settled (see
+    # `BatchResult.is_settled`), so lopsided matchups stop early and close
+    # ones get the trials.  With a `cache.ResultCache`, cached tallies count
+    # towards the total and every chunk is added to them; `rng` must then
+    # be a seed (see `resume_seed`).
+    result = None
+    if cache is not None:
+        key = cache.key(initiative)
+        result = cache.get(initiative, key)
+        rng = resume_seed(rng, result.trials if result is not None else 0)
+    rng = as_generator(rng)
+
+    while result is None or result.trials < max_trials:
+        if result is not None and result.is_settled(width, confidence):
+            break
+        done = result.trials if result is not None else 0
+        fresh = simulate(initiative, min(chunk, max_trials - done), rng)
+        if cache is not None:
+            cache.add(initiative, fresh, key)
+        result = fresh if result is None else result + fresh
+    return result
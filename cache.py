@@ -0,0 +1,168 @@
+import hashlib
+import json
+import sqlite3
+
+import numpy as np
+
+from batch import BatchResult
+from batch import resume_seed
+from batch import simulate
+from batch import tally_outcomes
+from combat import ENGINE_VERSION
+from schedule import round_robin
+from targeting import cannon_priority
+from targeting import missile_priority
+from unit import side_ids
+
+
+#
+# Classes
+#
+
+
+class ResultCache:
+
+    def __init__(self, path, timeout=30.0):
+        self.path = path
+        self.timeout = timeout
+        self._connect()
+
+    def _connect(self):
+        self._db = sqlite3.connect(self.path, timeout=self.timeout)
+        with self._db:
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS results ("
+                " key TEXT PRIMARY KEY,"
+                " trials INTEGER NOT NULL,"
+                " wins TEXT NOT NULL,"
+                " draws INTEGER NOT NULL,"
+                " survivals TEXT NOT NULL"
+                ")"
+            )
+
+    def __getstate__(self):
+        # Connections don't pickle; worker processes open their own
+        return {"path": self.path, "timeout": self.timeout}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._connect()
+
+    def close(self):
+        self._db.close()
+
+    def key(
+        self,
+        initiative,
+        missile_policy=missile_priority,
+        cannon_policy=cannon_priority,
+        schedule=round_robin,
+    ):
+        # Rules, then loadouts, starting damage and sides in initiative
+        # order, so the tallies line up position by position with whoever
+        # asks next.  Names, slot order and team labels don't change a
+        # battle and are left out.  The batch engines always fight by the
+        # default rules.
+        units = list(initiative.one_round())
+        signature = (
+            ENGINE_VERSION,
+            _rule_name(missile_policy),
+            _rule_name(cannon_policy),
+            _rule_name(schedule),
+            tuple(
+                (
+                    tuple(m.canonical_key() for m in u.signature()),
+                    u.absorbed_hits,
+                )
+                for u in units
+            ),
+            tuple(side_ids(u.team for u in units).tolist()),
+        )
+        return hashlib.sha256(repr(signature).encode()).hexdigest()
+
+    def get(self, initiative, key=None):
+        key = key or self.key(initiative)
+        row = self._db.execute(
+            "SELECT trials, wins, draws, survivals FROM results WHERE key = ?",
+            (key,),
+        ).fetchone()
+        if row is None:
+            return None
+        (trials, wins, draws, survivals) = row
+        return BatchResult(
+            list(initiative.one_round()),
+            trials,
+            wins=np.array(json.loads(wins)),
+            draws=draws,
+            survivals=np.array(json.loads(survivals)),
+        )
+
+    def add(self, initiative, result, key=None):
+        # Tallies accumulate, so separate runs of one matchup pool together
+        key = key or self.key(initiative)
+        with self._db:
+            # Take the write lock before reading, so concurrent workers can't
+            # both add onto the same old row
+            self._db.execute("BEGIN IMMEDIATE")
+            row = self._db.execute(
+                "SELECT trials, wins, draws, survivals FROM results"
+                " WHERE key = ?",
+                (key,),
+            ).fetchone()
+            (trials, wins, draws, survivals) = (
+                result.trials,
+                np.asarray(result.wins),
+                result.draws,
+                np.asarray(result.survivals),
+            )
+            if row is not None:
+                trials += row[0]
+                wins = wins + json.loads(row[1])
+                draws += row[2]
+                survivals = survivals + json.loads(row[3])
+            self._db.execute(
+                "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?)",
+                (
+                    key,
+                    int(trials),
+                    json.dumps(wins.tolist()),
+                    int(draws),
+                    json.dumps(survivals.tolist()),
+                ),
+            )
+
+    def record_battle(self, key, units):
+        # Tallies a single battle that has just been fought from the state
+        # `key` was taken in
+        alive = [u.is_alive() for u in units]
+        self.add(None, tally_outcomes(units, alive), key)
+
+
+#
+# Functions
+#
+
+
+def _rule_name(rule):
+    # Rules are keyed by where they are defined, so lambdas and nested
+    # functions, which could differ under one name, can't be cached
+    name = f"{rule.__module__}.{rule.__qualname__}"
+    if "<" in name:
+        raise ValueError(
+            f"Can't cache battles fought with {rule!r}; use a module-level "
+            f"function"
+        )
+    return name
+
+
+def simulate_cached(initiative, trials, cache, rng=None):
+    # Tops up the cached tallies to at least `trials` battles, simulating
+    # only the shortfall.  `rng` must be a seed (see `batch.resume_seed`).
+    key = cache.key(initiative)
+    cached = cache.get(initiative, key)
+    done = cached.trials if cached is not None else 0
+    if done >= trials:
+        return cached
+    fresh = simulate(initiative, trials - done, resume_seed(rng, done))
+    cache.add(initiative, fresh, key)
+    return cached + fresh if cached is not None else fresh
@@ -0,0 +1,165 @@
+from concurrent.futures import ProcessPoolExecutor
+import os
+import pickle
+
+from optimize import WinRate
+from sample import ModuleSampler
+from sample import random_modules
+from streams import RngStream
+from unit import Module
+from unit import power_balance
+
+
+#
+# Classes
+#
+
+
+class Evolution:
+
+    @classmethod
+    def resume(cls, checkpoint_path, max_workers=None):
+        with open(checkpoint_path, "rb") as f:
+            evolution = pickle.load(f)
+        evolution.checkpoint_path = checkpoint_path
+        evolution.max_workers = max_workers
+        return evolution
+
+    def __init__(
+        self,
+        opponents,
+        num_slots=5,
+        population_size=40,
+        trials=300,
+        seed=0,
+        mutation_rate=0.2,
+        elite=4,
+        num_candidates=1000,
+        checkpoint_path=None,
+        max_workers=None,
+    ):
+        self.objective = WinRate(opponents, trials=trials, seed=seed)
+        self.num_slots = num_slots
+        self.population_size = population_size
+        self.mutation_rate = mutation_rate
+        self.elite = elite
+        self.checkpoint_path = checkpoint_path
+        self.max_workers = max_workers
+        self.rng = RngStream(seed)
+        # Genomes are built and mutated from one pool of random modules, so
+        # a replacement that fits the power budget is a single draw
+        self.candidates = ModuleSampler(
+            random_modules(num_candidates, self.rng)
+        )
+        self.generation = 0
+        # Canonical loadout -> fitness; a genome is never simulated twice
+        self.fitness = {}
+        self.population = [
+            self.random_genome() for _ in range(population_size)
+        ]
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        del state["max_workers"]
+        return state
+
+    def _replace(self, genome, slot, balance):
+        # Puts a random module that fits in `slot`, returning the new balance
+        freed = balance - genome[slot].net_power()
+        module = self.candidates.sample(self.rng, freed)
+        if module is None:
+            return balance
+        genome[slot] = module
+        return freed + module.net_power()
+
+    def random_genome(self):
+        genome = [Module()]*self.num_slots
+        balance = 0
+        for slot in range(self.num_slots):
+            balance = self._replace(genome, slot, balance)
+        return tuple(genome)
+
+    def mutate(self, genome):
+        genome = list(genome)
+        balance = power_balance(genome)
+        for slot in range(self.num_slots):
+            if self.rng.random() < self.mutation_rate:
+                balance = self._replace(genome, slot, balance)
+        return tuple(genome)
+
+    def crossover(self, a, b):
+        child = tuple(
+            x if self.rng.random() < 0.5 else y for (x, y) in zip(a, b)
+        )
+        return child if power_balance(child) >= 0 else a
+
+    def evaluate(self, genomes):
+        pending = list(
+            {
+                signature(g): g for g in genomes
+                if signature(g) not in self.fitness
+            }.items()
+        )
+        if pending:
+            with ProcessPoolExecutor(max_workers=self.max_workers) as pool:
+                scores = pool.map(
+                    _evaluate,
+                    [self.objective]*len(pending),
+                    [g for (_, g) in pending],
+                    [self.num_slots]*len(pending),
+                )
+                for ((key, _), score) in zip(pending, scores):
+                    self.fitness[key] = score
+        return [self.fitness[signature(g)] for g in genomes]
+
+    def select(self, ranked, k=3):
+        # Tournament selection over a population sorted best first
+        return ranked[min(self.rng.randrange(len(ranked)) for _ in range(k))]
+
+    def step(self):
+        scores = self.evaluate(self.population)
+        ranked = [
+            g for (_, g) in sorted(
+                zip(scores, self.population),
+                key=lambda x: -x[0],
+            )
+        ]
+        children = ranked[:self.elite]
+        while len(children) < self.population_size:
+            child = self.crossover(self.select(ranked), self.select(ranked))
+            children.append(self.mutate(child))
+        self.population = children
+        self.generation += 1
+        self.checkpoint()
+        return ranked[0]
+
+    def run(self, generations):
+        for _ in range(generations):
+            self.step()
+        return self.best()
+
+    def best(self, top=1):
+        scores = self.evaluate(self.population)
+        ranked = sorted(zip(scores, self.population), key=lambda x: -x[0])
+        return ranked[:top]
+
+    def checkpoint(self):
+        if self.checkpoint_path is None:
+            return
+        tmp_path = f"{self.checkpoint_path}.tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump(self, f)
+        os.replace(tmp_path, self.checkpoint_path)
+
+
+#
+# Functions
+#
+
+
+def signature(genome):
+    return tuple(sorted(genome, key=Module.canonical_key))
+
+
+def _evaluate(objective, genome, num_slots):
+    return objective.evaluate(genome, num_slots)
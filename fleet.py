@@ -0,0 +1,232 @@
+import numpy as np
+
+from combat import HISTOGRAM_SIZE
+from combat import histogram_hits
+from combat import SELF_HITS
+from targeting import target_ranking
+from unit import Module
+from unit import side_ids
+from unit import STAT_FIELDS
+from unit import stats_array
+from unit import Unit
+
+
+#
+# Classes
+#
+
+
+class Fleet:
+
+    @classmethod
+    def from_units(cls, units):
+        units = list(units)
+        die_kinds = sorted(
+            {d for u in units for (d, _) in u.missile_pool + u.cannon_pool},
+            key=repr,
+        )
+        kind_index = {d: k for (k, d) in enumerate(die_kinds)}
+
+        def _counts(pools):
+            counts = np.zeros((len(units), len(die_kinds)), dtype=np.int32)
+            for (i, pool) in enumerate(pools):
+                for (d, n) in pool:
+                    counts[i, kind_index[d]] += n
+            return counts
+
+        return cls(
+            names=[u.name for u in units],
+            num_slots=np.array([u.num_slots for u in units], dtype=np.int32),
+            stats={
+                c: np.ascontiguousarray(column, dtype=np.int32)
+                for (c, column) in zip(
+                    STAT_FIELDS,
+                    stats_array(u.stats for u in units).reshape(
+                        len(units),
+                        len(STAT_FIELDS),
+                    ).T,
+                )
+            },
+            absorbed_hits=np.array(
+                [u.absorbed_hits for u in units],
+                dtype=np.int32,
+            ),
+            die_kinds=die_kinds,
+            missile_counts=_counts(u.missile_pool for u in units),
+            cannon_counts=_counts(u.cannon_pool for u in units),
+            teams=[u.team for u in units],
+        )
+
+    def __init__(
+        self,
+        names,
+        num_slots,
+        stats,
+        absorbed_hits,
+        die_kinds,
+        missile_counts,
+        cannon_counts,
+        teams=None,
+    ):
+        self.names = names
+        self.num_slots = num_slots
+        self.stats = stats
+        self.absorbed_hits = absorbed_hits
+        self.die_kinds = die_kinds
+        self.missile_counts = missile_counts
+        self.cannon_counts = cannon_counts
+        self.teams = teams if teams is not None else [None]*len(names)
+        self.sides = side_ids(self.teams)
+        self._expected_hits = None
+
+    def __len__(self):
+        return len(self.names)
+
+    @property
+    def hull_tank(self):
+        return self.stats["hull_tank"]
+
+    @property
+    def mitigation(self):
+        return self.stats["mitigation"]
+
+    @property
+    def targeting(self):
+        return self.stats["targeting"]
+
+    @property
+    def initiative(self):
+        return self.stats["initiative"]
+
+    def alive(self):
+        return self.absorbed_hits <= self.hull_tank
+
+    def is_alive(self, i):
+        return self.absorbed_hits[i] <= self.hull_tank[i]
+
+    def initiative_order(self):
+        return np.argsort(-self.initiative, kind="stable")
+
+    def target_ranking(self, counts):
+        position = np.empty(len(self), dtype=np.int64)
+        position[self.initiative_order()] = np.arange(len(self))
+        return target_ranking(self.hull_tank, counts.sum(axis=1), position)
+
+    def select_target(self, ranking, attacker):
+        eligible = (
+            self.alive()[ranking]
+            & (self.sides[ranking] != self.sides[attacker])
+        )
+        if not eligible.any():
+            return None
+        return int(ranking[eligible.argmax()])
+
+    def expected_hits(self, counts, attacker, defenders):
+        # Mean hits of one attacker's volley against each of `defenders`.
+        # Die distributions stop changing outside shifts -1 to 4.
+        shift = np.clip(
+            self.targeting[attacker] - self.mitigation[defenders],
+            -1,
+            4,
+        )
+        table = self._expected_hit_table()
+        return counts[attacker] @ table[:, shift + 1]
+
+    def _expected_hit_table(self):
+        # Mean hits per die, one row per die kind, columns shifts -1 to 4
+        if self._expected_hits is None:
+            self._expected_hits = np.array(
+                [
+                    [
+                        sum(h*p for ((h, _), p) in die.distribution(shift))
+                        for shift in range(-1, 5)
+                    ]
+                    for die in self.die_kinds
+                ]
+            ).reshape(len(self.die_kinds), 6)
+        return self._expected_hits
+
+    def select_targets(self, ranking, counts, attackers):
+        # `select_target` for a round of simultaneous fire, -1 where there
+        # is no enemy left.  Attackers go in order, each passing over
+        # enemies whose remaining hull is already covered by the expected
+        # hits of earlier volleys; once every enemy is covered, fire piles
+        # onto the top-ranked one.
+        alive = self.alive()[ranking]
+        remaining = (self.hull_tank - self.absorbed_hits + 1)[ranking]
+        pending = np.zeros(len(ranking))
+        targets = np.full(len(attackers), -1)
+        for (k, a) in enumerate(attackers):
+            enemies = alive & (self.sides[ranking] != self.sides[a])
+            if not enemies.any():
+                continue
+            uncovered = enemies & (pending < remaining)
+            r = (uncovered if uncovered.any() else enemies).argmax()
+            targets[k] = ranking[r]
+            pending[r] += self.expected_hits(counts, a, ranking[r])
+        return targets
+
+    def sides_alive(self):
+        return np.unique(self.sides[self.alive()])
+
+    def roll(self, rng, counts, shift):
+        hits = 0
+        self_hits = 0
+        for (die, count) in zip(self.die_kinds, counts):
+            if count == 0:
+                continue
+            outcomes = die.distribution(shift)
+            drawn = rng.multinomial(count, [p for (_, p) in outcomes])
+            for (((h, s), _), n) in zip(outcomes, drawn):
+                hits += h*n
+                self_hits += s*n
+        return (int(hits), int(self_hits))
+
+    def roll_volleys(self, rng, counts, attackers, shift):
+        # One volley per attacker, each die kind rolled for all of them in a
+        # single draw.  Returns (hits, self_hits) arrays.
+        histograms = np.zeros(
+            (len(attackers), HISTOGRAM_SIZE),
+            dtype=np.int64,
+        )
+        for (k, die) in enumerate(self.die_kinds):
+            histograms += die.roll_many(rng, counts[attackers, k])
+        return (histogram_hits(histograms, shift), histograms[:, SELF_HITS])
+
+    def clear_hits(self):
+        self.absorbed_hits[:] = 0
+        return self
+
+    def dice(self, counts, i):
+        return tuple(
+            d for (d, n) in zip(self.die_kinds, counts[i]) for _ in range(n)
+        )
+
+    def to_units(self):
+        # Module breakdowns aren't kept, so each exported unit carries its
+        # totals in a single module
+        units = []
+        for i in range(len(self)):
+            aggregate = Module(
+                missile_dice=self.dice(self.missile_counts, i),
+                cannon_dice=self.dice(self.cannon_counts, i),
+                **{c: int(self.stats[c][i]) for c in STAT_FIELDS},
+            )
+            num_slots = max(int(self.num_slots[i]), 1)
+            unit = Unit(
+                self.names[i],
+                num_slots=num_slots,
+                modules=[aggregate] + [Module()]*(num_slots - 1),
+                team=self.teams[i],
+            )
+            unit.absorbed_hits = int(self.absorbed_hits[i])
+            units.append(unit)
+        return units
+
+    def update_units(self, units):
+        for (unit, absorbed) in zip(units, self.absorbed_hits):
+            unit.absorbed_hits = int(absorbed)
+        return units
+
+    def __repr__(self):
+        return f"<Fleet of {len(self)}>"
@@ -10,17 +10,76 @@ class Initiative:
             key=lambda u: u.stats["initiative"],
             reverse=True,
         )
+        self._position = {id(u): i for (i, u) in enumerate(self.initiative)}
+        self.reset()
+
+    def reset(self):
+        # Living units form a ring of positions in initiative order.  Unlinked
+        # positions keep their forward pointer, so a walk that is parked on a
+        # unit when it dies can still find its way to the next living one.
+        alive = [i for (i, u) in enumerate(self.initiative) if u.is_alive()]
+        n = len(self.initiative)
+        self._next = [None]*n
+        self._prev = [None]*n
+        self._linked = [False]*n
+        for (k, i) in enumerate(alive):
+            self._next[i] = alive[(k + 1) % len(alive)]
+            self._prev[i] = alive[k - 1]
+            self._linked[i] = True
+        self._head = alive[0] if alive else None
+        self._num_alive = len(alive)
+        return self
+
+    def mark_dead(self, unit):
+        i = self._position[id(unit)]
+        if not self._linked[i]:
+            return
+        self._linked[i] = False
+        self._num_alive -= 1
+        if self._num_alive == 0:
+            self._head = None
+            return
+        (prev, next_) = (self._prev[i], self._next[i])
+        self._next[prev] = next_
+        self._prev[next_] = prev
+        if self._head == i:
+            self._head = next_
+
+    def _advance(self, i):
+        j = self._next[i]
+        while not self._linked[j]:
+            j = self._next[j]
+        return j
 
     def one_round(self):
         return iter(self.initiative)
 
     def is_everybody_dead(self):
-        return all(not u.is_alive() for u in self.initiative)
+        # Units can die without anyone calling `mark_dead`, so catch up on
+        # the head of the ring before trusting the count
+        while self._head is not None:
+            head = self.initiative[self._head]
+            if head.is_alive():
+                break
+            self.mark_dead(head)
+        return self._num_alive == 0
 
     def alive(self):
-        for u in self.initiative:
+        if self.is_everybody_dead():
+            return
+        i = self._head
+        while True:
+            u = self.initiative[i]
             if u.is_alive():
                 yield u
+            else:
+                self.mark_dead(u)
+            if self._num_alive == 0:
+                return
+            j = self._advance(i)
+            if j <= i:
+                return
+            i = j
 
     def cycle_alive(self):
         while True:
@@ -0,0 +1,147 @@
+from dataclasses import dataclass
+
+import numpy as np
+
+from combat import canonical_pool
+from combat import MAX_ROUNDS
+from combat import VolleyDistribution
+
+
+#
+# Classes
+#
+
+
+@dataclass(frozen=True)
+class MatchupEntry:
+
+    missile_distribution: VolleyDistribution
+    cannon_distribution: VolleyDistribution
+    expected_missile_hits: float
+    expected_hits: float
+    # kill_curve[t] is the chance the defender is dead after t cannon volleys
+    kill_curve: np.ndarray
+    turns_to_kill: float
+
+
+class DamageMatrix:
+
+    def __init__(self, units, horizon=MAX_ROUNDS):
+        self.units = list(units)
+        self.horizon = horizon
+        # Entries depend only on the attacker's dice and targeting and the
+        # defender's mitigation and hull, so they're cached on those
+        self._entries = {}
+        self._signatures = [None]*len(self.units)
+        n = len(self.units)
+        self.expected_hits = np.zeros((n, n))
+        self.expected_missile_hits = np.zeros((n, n))
+        self.turns_to_kill = np.full((n, n), np.inf)
+        self.kill_probability = np.zeros((n, n))
+        for i in range(n):
+            self.refresh(i)
+
+    def __len__(self):
+        return len(self.units)
+
+    def entry(self, attacker, defender):
+        return self._entry(self.units[attacker], self.units[defender])
+
+    def add_unit(self, unit):
+        n = len(self.units)
+        self.units.append(unit)
+        self._signatures.append(None)
+        self.expected_hits = _grow(self.expected_hits, 0)
+        self.expected_missile_hits = _grow(self.expected_missile_hits, 0)
+        self.turns_to_kill = _grow(self.turns_to_kill, np.inf)
+        self.kill_probability = _grow(self.kill_probability, 0)
+        self.refresh(n)
+        return n
+
+    def refresh(self, i):
+        # Call after unit i's modules change; only its row and column are
+        # recomputed, and only if its loadout actually differs
+        signature = self.units[i].signature()
+        if signature == self._signatures[i]:
+            return False
+        self._signatures[i] = signature
+
+        for j in range(len(self.units)):
+            if i == j:
+                continue
+            self._store(i, j)
+            self._store(j, i)
+        return True
+
+    def _store(self, a, d):
+        entry = self.entry(a, d)
+        self.expected_hits[a, d] = entry.expected_hits
+        self.expected_missile_hits[a, d] = entry.expected_missile_hits
+        self.turns_to_kill[a, d] = entry.turns_to_kill
+        self.kill_probability[a, d] = entry.kill_curve[-1]
+
+    def _entry(self, attacker, defender):
+        key = (_attacker_profile(attacker), _defender_profile(defender))
+        if key not in self._entries:
+            self._entries[key] = _matchup_entry(
+                attacker,
+                defender,
+                self.horizon,
+            )
+        return self._entries[key]
+
+
+#
+# Helpers
+#
+
+
+def _attacker_profile(unit):
+    return (
+        canonical_pool(unit.missile_pool),
+        canonical_pool(unit.cannon_pool),
+        unit.stats["targeting"],
+    )
+
+
+def _defender_profile(unit):
+    return (unit.stats["mitigation"], unit.stats["hull_tank"])
+
+
+def _grow(matrix, fill):
+    n = matrix.shape[0]
+    grown = np.full((n + 1, n + 1), fill, dtype=matrix.dtype)
+    grown[:n, :n] = matrix
+    return grown
+
+
+def _kill_curve(hits_pmf, hull, horizon):
+    # Track the distribution of absorbed hits among survivors (0..hull); the
+    # missing mass is the chance the defender is already dead
+    alive = np.zeros(hull + 1)
+    alive[0] = 1.0
+    curve = np.zeros(horizon + 1)
+    for t in range(1, horizon + 1):
+        alive = np.convolve(alive, hits_pmf)[:hull + 1]
+        curve[t] = 1.0 - alive.sum()
+    return curve
+
+
+def _matchup_entry(attacker, defender, horizon):
+    missile = defender.mitigate(attacker.missile_distribution())
+    cannon = defender.mitigate(attacker.cannon_distribution())
+    hull = max(defender.stats["hull_tank"], 0)
+    curve = _kill_curve(cannon.hits_pmf(), hull, horizon)
+    # Expected volleys to kill, counting a survivor of the whole horizon as
+    # taking the full horizon
+    turns_to_kill = (
+        float((1.0 - curve[:-1]).sum()) if curve[-1] > 0 else np.inf
+    )
+    return MatchupEntry(
+        missile_distribution=missile,
+        cannon_distribution=cannon,
+        expected_missile_hits=missile.expected_hits(),
+        expected_hits=cannon.expected_hits(),
+        kill_curve=curve,
+        turns_to_kill=turns_to_kill,
+    )
@@ -0,0 +1,218 @@
+import numpy as np
+
+from batch import simulate
+from combat import VolleyDistribution
+from initiative import Initiative
+from unit import Module
+from unit import Unit
+
+
+#
+# Objectives
+#
+
+
+# Objectives are searched one "key level" at a time.  Within a level the score
+# is a monotone function of a sum over modules, so the search is a knapsack
+# over slots and power.  Loadouts whose key stat reaches a level are scored at
+# that level, which never overestimates them, so the best level finds the
+# optimum exactly.
+
+
+class ExpectedDamage:
+
+    def __init__(self, mitigation=0, missile_weight=1.0):
+        self.mitigation = mitigation
+        self.missile_weight = missile_weight
+
+    def key(self, module):
+        return module.targeting
+
+    def levels(self, catalog, num_slots):
+        best = max((max(m.targeting, 0) for m in catalog), default=0)
+        return range(best*num_slots + 1)
+
+    def value(self, module, level):
+        cannon = VolleyDistribution.from_dice(
+            module.cannon_dice,
+            level,
+            self.mitigation,
+        )
+        missile = VolleyDistribution.from_dice(
+            module.missile_dice,
+            level,
+            self.mitigation,
+        )
+        return (
+            cannon.expected_hits() +
+            self.missile_weight*missile.expected_hits()
+        )
+
+    def score(self, level, total):
+        return total
+
+    def evaluate(self, modules):
+        level = sum(self.key(m) for m in modules)
+        return self.score(level, sum(self.value(m, level) for m in modules))
+
+
+class Survivability:
+
+    def __init__(self, cannon_dice, targeting=0):
+        self.cannon_dice = tuple(cannon_dice)
+        self.targeting = targeting
+
+    def key(self, module):
+        return module.mitigation
+
+    def levels(self, catalog, num_slots):
+        best = max((max(m.mitigation, 0) for m in catalog), default=0)
+        return range(best*num_slots + 1)
+
+    def value(self, module, level):
+        return module.hull_tank
+
+    def score(self, level, total):
+        # Expected reference volleys needed to absorb more than the hull
+        expected = VolleyDistribution.from_dice(
+            self.cannon_dice,
+            self.targeting,
+            level,
+        ).expected_hits()
+        return (total + 1)/expected if expected > 0 else np.inf
+
+    def evaluate(self, modules):
+        level = sum(self.key(m) for m in modules)
+        return self.score(level, sum(self.value(m, level) for m in modules))
+
+
+class WinRate:
+
+    def __init__(self, opponents, trials=500, seed=0, surrogates=None):
+        self.opponents = list(opponents)
+        self.trials = trials
+        self.seed = seed
+        # Win rate isn't additive over modules, so candidates come from
+        # searching these objectives and are then re-ranked by simulation
+        self.surrogates = surrogates or [
+            ExpectedDamage(
+                mitigation=int(
+                    np.median([o.stats["mitigation"] for o in self.opponents])
+                ),
+            ),
+            Survivability(
+                [d for o in self.opponents for d in o.cannon_dice],
+            ),
+        ]
+
+    def evaluate(self, modules, num_slots=None):
+        num_slots = num_slots or len(modules)
+        unit = loadout_unit("candidate", modules, num_slots)
+        rates = []
+        for (i, opponent) in enumerate(self.opponents):
+            result = simulate(
+                Initiative([unit, opponent]),
+                self.trials,
+                np.random.SeedSequence(self.seed, spawn_key=(i,)),
+            )
+            rates.append(result.win_rates()[result.units.index(unit)])
+        return float(np.mean(rates))
+
+
+#
+# Helpers
+#
+
+
+def _search_level(catalog, num_slots, objective, level):
+    # States are (power balance, key stat capped at the level), bucketed by
+    # slots used, each keeping the best partial sum seen and the catalog
+    # indices chosen.  Catalog items are taken in order, with repeats, so
+    # every multiset is reached once.
+    values = [objective.value(m, level) for m in catalog]
+    nets = [m.net_power() for m in catalog]
+    keys = [max(objective.key(m), 0) for m in catalog]
+    best_gain = max([0] + nets)
+    balance_cap = num_slots*max([0] + [-n for n in nets])
+
+    states = [{} for _ in range(num_slots + 1)]
+    states[0][(0, 0)] = (0.0, ())
+    for (i, (net, gain, value_i)) in enumerate(zip(nets, keys, values)):
+        for used in range(num_slots):
+            following = states[used + 1]
+            # A balance the remaining slots can't make up is hopeless
+            floor = -(num_slots - used - 1)*best_gain
+            for ((balance, key), (value, chosen)) in list(
+                states[used].items()
+            ):
+                new_balance = balance + net
+                if new_balance < floor:
+                    continue
+                if new_balance > balance_cap:
+                    new_balance = balance_cap
+                new_key = key + gain
+                if new_key > level:
+                    new_key = level
+                new_value = value + value_i
+                best = following.get((new_balance, new_key))
+                if best is None or best[0] < new_value:
+                    following[(new_balance, new_key)] = (
+                        new_value,
+                        chosen + (i,),
+                    )
+
+    return [
+        (objective.score(level, value), chosen)
+        for bucket in states
+        for ((balance, key), (value, chosen)) in bucket.items()
+        if balance >= 0 and key >= level
+    ]
+
+
+def _search(catalog, num_slots, objective, top):
+    found = {}
+    for level in objective.levels(catalog, num_slots):
+        for (_, chosen) in _search_level(catalog, num_slots, objective, level):
+            modules = tuple(catalog[i] for i in chosen)
+            signature = tuple(sorted(chosen))
+            if signature not in found:
+                found[signature] = (objective.evaluate(modules), modules)
+    ranked = sorted(found.values(), key=lambda x: -x[0])
+    return ranked[:top]
+
+
+#
+# Main functions
+#
+
+
+def loadout_unit(name, modules, num_slots):
+    modules = list(modules)
+    return Unit(
+        name,
+        num_slots=num_slots,
+        modules=modules + [Module()]*(num_slots - len(modules)),
+    )
+
+
+def best_loadouts(catalog, num_slots, objective, top=5):
+    # Returns [(score, modules), ...], best first.  Slots left empty are
+    # simply not listed.
+    catalog = list(dict.fromkeys(catalog))
+
+    if isinstance(objective, WinRate):
+        candidates = {}
+        for surrogate in objective.surrogates:
+            for (_, modules) in _search(catalog, num_slots, surrogate, top*4):
+                key = tuple(sorted(modules, key=Module.canonical_key))
+                candidates[key] = modules
+        ranked = sorted(
+            (
+                (objective.evaluate(modules, num_slots), modules)
+                for modules in candidates.values()
+            ),
+            key=lambda x: -x[0],
+        )
+        return ranked[:top]
+
+    return _search(catalog, num_slots, objective, top)
@@ -1,91 +1,128 @@
-import random
-
-from choice import Choice
+from bisect import bisect_left
+from bisect import bisect_right
+from itertools import accumulate
+import numpy as np
 
 from unit import Unit
 from unit import Module
+from unit import MODULES
 from unit import NormalDie
+from unit import power_balance
 from unit import RiftDie
 
 from rect import RectLRBT
+from streams import as_generator
+from streams import RngStream
 
 
 #
-# Choice helpers
+# Compiled samplers
 #
 
 
-def _weighted(*seq):
-    return Choice.flat(Choice.weighted(*x) for x in seq)
+class WeightedSampler:
+
+    def __init__(self, *seq):
+        # Same (weight, value) pairs as the old `Choice.weighted` helpers.
+        # These distributions have at most a handful of outcomes, so a
+        # cumulative table with bisection beats building alias tables.
+        self.values = [v for (_, v) in seq]
+        self.cumulative = list(accumulate(w for (w, _) in seq))
+        self.total = self.cumulative[-1]
+        self._cumulative_array = np.array(self.cumulative, dtype=float)
+
+    def sample(self, rng):
+        k = bisect_right(self.cumulative, rng.random()*self.total)
+        return self.values[k]
+
+    def sample_indices(self, generator, size):
+        u = generator.random(size)*self.total
+        return np.searchsorted(self._cumulative_array, u, side="right")
+
+    def sample_many(self, generator, size):
+        return [self.values[i] for i in self.sample_indices(generator, size)]
+
+
+class ModuleSampler:
+
+    def __init__(self, modules):
+        # Sorted by net power, so the modules that fit a power balance are
+        # always a suffix of the list
+        self.modules = sorted(modules, key=Module.net_power)
+        self.nets = [m.net_power() for m in self.modules]
+
+    def sample(self, rng, balance):
+        # A uniform pick among the modules that keep `balance` non-negative,
+        # or None if none do
+        first_feasible = bisect_left(self.nets, -balance)
+        if first_feasible == len(self.modules):
+            return None
+        return self.modules[rng.randrange(first_feasible, len(self.modules))]
+
+
+NUM_DICE = WeightedSampler((15, 1), (8, 2), (2, 3), (1, 4))
+NUM_PIPS = WeightedSampler((8, 1), (3, 2), (3, 3), (1, 4))
+DIE_KIND = WeightedSampler((10, NormalDie), (2, RiftDie))
+NUM_EFFECTS = WeightedSampler((10, 1), (3, 2), (1, 3))
+NUM_SLOTS = WeightedSampler((10, 5), (5, 8), (2, 10))
+
+PROPS = [
+    "missile_dice",
+    "missile_dice",
+    "cannon_dice",
+    "cannon_dice",
+    "cannon_dice",
+    "hull_tank",
+    "hull_tank",
+    "mitigation",
+    "mitigation",
+    "targeting",
+    "power",
+    "power",
+    "power",
+    "power",
+    "speed",
+    "initiative",
+    "initiative",
+]
+PROP_VALUES = {
+    "targeting": WeightedSampler((10, 1), (5, 2), (1, 3)),
+    "mitigation": WeightedSampler((10, 1), (5, 2), (1, 3)),
+    "hull_tank": WeightedSampler((10, 1), (5, 2), (1, 3)),
+    "power": WeightedSampler((3, 1), (10, 2), (5, 3), (1, 4)),
+    "speed": WeightedSampler((10, 1), (5, 2), (1, 3)),
+    "initiative": WeightedSampler((10, 1), (5, 2), (1, 3)),
+}
+DICE_PROPS = ("missile_dice", "cannon_dice")
 
 
 #
-# Functions
+# Helpers
 #
 
 
-def _dice():
-    num_dice = _weighted((15, 1), (8, 2), (2, 3), (1, 4))
-    num_pips = _weighted((8, 1), (3, 2), (3, 3), (1, 4))
-    kind = _weighted((10, NormalDie), (2, RiftDie))
+def _die_list(kind, num_dice, num_pips):
+    return tuple([kind(num_pips) if kind is not RiftDie else kind()]*num_dice)
 
-    @Choice.delayed
-    def _die_list(k, d, p):
-        return tuple([k(p) if k is not RiftDie else k()]*d)
 
+def _sample_dice(rng):
+    kind = DIE_KIND.sample(rng)
+    num_dice = NUM_DICE.sample(rng)
+    num_pips = NUM_PIPS.sample(rng)
     return _die_list(kind, num_dice, num_pips)
 
 
-def random_module(rng=None):
-    rng = rng or random.Random()
-
-    def _weighted(*seq):
-        return Choice.flat(Choice.weighted(*x) for x in seq)
-
-    num_effects = _weighted((10, 1), (3, 2), (1, 3)).evaluate(rng)
-
-    props = [
-        "missile_dice",
-        "missile_dice",
-        "cannon_dice",
-        "cannon_dice",
-        "cannon_dice",
-        "hull_tank",
-        "hull_tank",
-        "mitigation",
-        "mitigation",
-        "targeting",
-        "power",
-        "power",
-        "power",
-        "power",
-        "speed",
-        "initiative",
-        "initiative",
-    ]
-    rng.shuffle(props)
-    taken_props = props[:num_effects]
-    prop_values = {
-        "missile_dice": _dice(),
-        "cannon_dice": _dice(),
-        "targeting": _weighted((10, 1), (5, 2), (1, 3)),
-        "mitigation": _weighted((10, 1), (5, 2), (1, 3)),
-        "hull_tank": _weighted((10, 1), (5, 2), (1, 3)),
-        "power": _weighted((3, 1), (10, 2), (5, 3), (1, 4)),
-        "speed": _weighted((10, 1), (5, 2), (1, 3)),
-        "initiative": _weighted((10, 1), (5, 2), (1, 3)),
-    }
-    params = {p: prop_values[p].evaluate(rng) for p in taken_props}
+def _die_value(dice):
+    match dice:
+        case [RiftDie(), *rest]:
+            return 5*len(dice)
+        case [NormalDie(x), *rest]:
+            return x*len(dice)
+        case _:
+            return 0
 
-    def _die_value(dice):
-        match dice:
-            case [RiftDie(), *rest]:
-                return 5*len(dice)
-            case [NormalDie(x), *rest]:
-                return x*len(dice)
-            case _:
-                return 0
 
+def _module_from_params(params):
     # Can't provide power with modules that provide attack
     if (
         params.get("power") and
@@ -104,13 +141,67 @@ def random_module(rng=None):
     else:
         params["power_cost"] = 0
 
-    return Module(**params)
+    return MODULES.intern(Module(**params))
+
+
+#
+# Functions
+#
+
+
+def random_module(rng=None):
+    rng = rng or RngStream()
+
+    num_effects = NUM_EFFECTS.sample(rng)
+
+    props = list(PROPS)
+    rng.shuffle(props)
+    taken_props = props[:num_effects]
+    params = {
+        p: _sample_dice(rng) if p in DICE_PROPS else PROP_VALUES[p].sample(rng)
+        for p in taken_props
+    }
+
+    return _module_from_params(params)
 
 
-def random_unit(name, rng=None):
-    rng = rng or random.Random()
+def random_modules(count, rng=None):
+    # Draws every random choice for `count` modules up front in vectorized
+    # form; only the final Module construction is per-module
+    generator = as_generator(rng)
 
-    num_slots = _weighted((10, 5), (5, 8), (2, 10)).evaluate(rng)
+    num_effects = NUM_EFFECTS.sample_many(generator, count)
+    orders = np.argsort(generator.random((count, len(PROPS))), axis=1)
+    values = {
+        p: sampler.sample_many(generator, count)
+        for (p, sampler) in PROP_VALUES.items()
+    }
+    dice = {
+        p: list(
+            zip(
+                DIE_KIND.sample_many(generator, count),
+                NUM_DICE.sample_many(generator, count),
+                NUM_PIPS.sample_many(generator, count),
+            )
+        )
+        for p in DICE_PROPS
+    }
+
+    modules = []
+    for i in range(count):
+        taken_props = [PROPS[k] for k in orders[i, :num_effects[i]]]
+        params = {
+            p: _die_list(*dice[p][i]) if p in DICE_PROPS else values[p][i]
+            for p in taken_props
+        }
+        modules.append(_module_from_params(params))
+    return modules
+
+
+def random_unit(name, rng=None, steps=300):
+    rng = rng or RngStream()
+
+    num_slots = NUM_SLOTS.sample(rng)
     starting_modules = [
         Module(power=3),
         Module(cannon_dice=[NormalDie(2)]*2),
@@ -118,27 +209,30 @@ def random_unit(name, rng=None):
         Module(cannon_dice=[NormalDie(1)]*1),
     ]
     leftovers = num_slots - len(starting_modules)
-    unit = Unit(
-        name,
-        num_slots=num_slots,
-        modules=starting_modules + [Module()]*leftovers,
-    )
-    for _ in range(300):
-        try:
-            slot = random.randint(0, num_slots-1)
-            unit.slot_module(slot, random_module(rng))
-        except ValueError:
-            pass
+    modules = starting_modules + [Module()]*leftovers
+
+    candidates = ModuleSampler(random_modules(steps, rng))
+    budget = power_balance(modules)
+
+    for _ in range(steps):
+        slot = rng.randrange(num_slots)
+        freed = budget - modules[slot].net_power()
+        module = candidates.sample(rng, freed)
+        if module is None:
+            continue
+        modules[slot] = module
+        budget = freed + module.net_power()
 
-    return unit
+    return Unit(name, num_slots=num_slots, modules=modules)
 
 
 def random_rect_within(rect, width, height, rng=None):
-    x = random.randint(
+    rng = rng or RngStream()
+    x = rng.randint(
         int(rect.topleft.x),
         int(rect.topright.x),
     )
-    y = random.randint(
+    y = rng.randint(
         int(rect.bottomleft.y),
         int(rect.topleft.y),
     )
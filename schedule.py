@@ -0,0 +1,77 @@
+from fractions import Fraction
+import heapq
+
+import numpy as np
+
+
+#
+# Policies
+#
+
+
+# A schedule maps an `Initiative` to the living units in the order they take
+# cannon turns, skipping units as they die and stopping once none are left.
+
+
+def round_robin(initiative):
+    return initiative.cycle_alive()
+
+
+def speed_interval(unit):
+    # Time between a unit's turns; speed 0 acts once per unit of time
+    return Fraction(1, 1 + max(unit.stats["speed"], 0))
+
+
+def timeline(initiative, interval=speed_interval):
+    # Each unit acts every `interval(unit)`, first at time `interval(unit)`.
+    # Turns at the same time go in initiative order, so with equal speeds
+    # this is the round-robin.  Dead units are dropped as they surface.
+    heap = [
+        (interval(u), i, interval(u), u)
+        for (i, u) in enumerate(initiative.initiative)
+        if u.is_alive()
+    ]
+    heapq.heapify(heap)
+    while heap:
+        (time, i, step, unit) = heapq.heappop(heap)
+        if not unit.is_alive():
+            initiative.mark_dead(unit)
+            continue
+        yield unit
+        heapq.heappush(heap, (time + step, i, step, unit))
+
+
+#
+# Functions
+#
+
+
+def next_alive(alive, cursor):
+    # Vectorized round-robin: for each row of `alive`, the first living unit
+    # at or after `cursor`, wrapping around, and whether there was one
+    n = alive.shape[1]
+    rotated = (cursor[:, None] + np.arange(n)[None, :]) % n
+    rotated_alive = np.take_along_axis(alive, rotated, axis=1)
+    found = rotated_alive.any(axis=1)
+    first = rotated_alive.argmax(axis=1)
+    return (rotated[np.arange(len(cursor)), first], found)
+
+
+def turn_sequence(initiative, schedule, turns):
+    # Initiative positions of the turns `schedule` gives if nobody dies,
+    # until every living unit has had `turns` of them.  Deaths only ever
+    # remove a unit's later turns, so skipping dead units' entries replays
+    # the schedule for any battle.
+    initiative.reset()
+    position = {id(u): i for (i, u) in enumerate(initiative.initiative)}
+    counts = {id(u): 0 for u in initiative.initiative if u.is_alive()}
+    sequence = []
+    remaining = len(counts)
+    for unit in schedule(initiative):
+        if remaining == 0:
+            break
+        sequence.append(position[id(unit)])
+        counts[id(unit)] += 1
+        if counts[id(unit)] == turns:
+            remaining -= 1
+    return sequence
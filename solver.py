@@ -0,0 +1,180 @@
+import numpy as np
+
+from combat import MAX_ROUNDS
+from combat import VolleyDistribution
+from schedule import next_alive
+from targeting import target_ranking
+from unit import side_ids
+
+
+#
+# Classes
+#
+
+
+class ExactResult:
+
+    def __init__(self, units, wins, draws, survivals):
+        self.units = units
+        self.wins = wins
+        self.draws = draws
+        self.survivals = survivals
+
+    def win_rates(self):
+        return self.wins
+
+    def draw_rate(self):
+        return self.draws
+
+    def survival_rates(self):
+        return self.survivals
+
+    def __repr__(self):
+        f_wins = ", ".join(
+            f"{u}={w:.3f}" for (u, w) in zip(self.units, self.wins)
+        )
+        return f"<ExactResult wins=[{f_wins}] draws={self.draws:.3f}>"
+
+
+#
+# Helpers
+#
+
+
+def _select_target(ranking, alive, attacker, sides):
+    for t in ranking:
+        if alive[t] and sides[t] != sides[attacker]:
+            return t
+    return None
+
+
+def _transitions(pools, targeting, mitigation):
+    # (attacker, defender) -> [(hits, self_hits, probability), ...]
+    n = len(pools)
+    table = {}
+    for a in range(n):
+        for d in range(n):
+            if a == d:
+                continue
+            pmf = VolleyDistribution.from_pool(
+                pools[a],
+                targeting[a],
+                mitigation[d],
+            ).pmf
+            table[(a, d)] = [
+                (int(h), int(s), float(pmf[h, s]))
+                for (h, s) in zip(*np.nonzero(pmf))
+            ]
+    return table
+
+
+def _add(dist, state, p):
+    dist[state] = dist.get(state, 0) + p
+
+
+#
+# Main functions
+#
+
+
+def solve(initiative):
+    units = list(initiative.one_round())
+    n = len(units)
+
+    hull = [u.stats["hull_tank"] for u in units]
+    targeting = [u.stats["targeting"] for u in units]
+    mitigation = [u.stats["mitigation"] for u in units]
+    sides = side_ids(u.team for u in units)
+    missile_pools = [u.missile_pool for u in units]
+    cannon_pools = [u.cannon_pool for u in units]
+    missile_ranking = target_ranking(
+        hull,
+        [sum(c for (_, c) in p) for p in missile_pools],
+    ).tolist()
+    cannon_ranking = target_ranking(
+        hull,
+        [sum(c for (_, c) in p) for p in cannon_pools],
+    ).tolist()
+    missile_table = _transitions(missile_pools, targeting, mitigation)
+    cannon_table = _transitions(cannon_pools, targeting, mitigation)
+
+    # Absorbed hits are capped one past the hull, since any more is just as
+    # dead
+    cap = [h + 1 for h in hull]
+
+    def _alive(absorbed):
+        return [absorbed[i] <= hull[i] for i in range(n)]
+
+    def _absorb(absorbed, i, hits):
+        absorbed = list(absorbed)
+        absorbed[i] = min(absorbed[i] + hits, cap[i])
+        return tuple(absorbed)
+
+    start = tuple(min(u.absorbed_hits, c) for (u, c) in zip(units, cap))
+
+    # Missile phase: the distribution over absorbed hits after each attacker
+    dist = {start: 1.0}
+    for attacker in range(n):
+        new_dist = {}
+        for (absorbed, p) in dist.items():
+            alive = _alive(absorbed)
+            defender = (
+                _select_target(missile_ranking, alive, attacker, sides)
+                if alive[attacker] else None
+            )
+            if defender is None:
+                _add(new_dist, absorbed, p)
+                continue
+            for (hits, _, q) in missile_table[(attacker, defender)]:
+                _add(new_dist, _absorb(absorbed, defender, hits), p*q)
+        dist = new_dist
+
+    # Cannon phase: states are (absorbed hits, turn order cursor), stepped
+    # forward one turn at a time until they terminate
+    finished = {}
+    dist = {(absorbed, 0): p for (absorbed, p) in dist.items()}
+    for _ in range(MAX_ROUNDS):
+        if not dist:
+            break
+        states = list(dist.items())
+        alive_states = np.array([_alive(a) for ((a, _), _) in states])
+        (attackers, found) = next_alive(
+            alive_states,
+            np.array([cursor for ((_, cursor), _) in states]),
+        )
+        new_dist = {}
+        for (((absorbed, _), p), alive, attacker, any_alive) in zip(
+            states,
+            alive_states.tolist(),
+            attackers.tolist(),
+            found.tolist(),
+        ):
+            defender = (
+                _select_target(cannon_ranking, alive, attacker, sides)
+                if any_alive else None
+            )
+            if defender is None:
+                _add(finished, absorbed, p)
+                continue
+            for (hits, self_hits, q) in cannon_table[(attacker, defender)]:
+                after = _absorb(absorbed, attacker, self_hits)
+                after = _absorb(after, defender, hits)
+                _add(new_dist, (after, attacker + 1), p*q)
+        dist = new_dist
+
+    for ((absorbed, _), p) in dist.items():
+        _add(finished, absorbed, p)
+
+    wins = np.zeros(n)
+    survivals = np.zeros(n)
+    draws = 0.0
+    for (absorbed, p) in finished.items():
+        alive = np.array(_alive(absorbed))
+        survivals += p*alive
+        standing = set(sides[alive])
+        if len(standing) == 1:
+            wins[sides == standing.pop()] += p
+        else:
+            draws += p
+
+    return ExactResult(units, wins, draws, survivals)
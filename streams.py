@@ -0,0 +1,76 @@
+import random
+
+import numpy as np
+
+
+#
+# Classes
+#
+
+
+class RngStream(random.Random):
+
+    # A `random.Random` seeded from a NumPy SeedSequence, with a PCG64
+    # Generator on the side for vectorized draws.  Streams spawn independent
+    # substreams, so work split across processes or machines reproduces
+    # exactly from one root seed however it is scheduled.
+
+    def __init__(self, seed=None):
+        if not isinstance(seed, np.random.SeedSequence):
+            seed = np.random.SeedSequence(seed)
+        self.seed_sequence = seed
+        self._generator = None
+        # PCG64 takes the first four words of the state; Mersenne Twister
+        # gets the next four, so the two never share seed material
+        words = seed.generate_state(8, np.uint64)[4:]
+        super().__init__(int.from_bytes(words.tobytes(), "little"))
+
+    def __reduce__(self):
+        return (
+            _unpickle_stream,
+            (self.seed_sequence, self.getstate(), self._generator),
+        )
+
+    @property
+    def generator(self):
+        if self._generator is None:
+            self._generator = np.random.Generator(
+                np.random.PCG64(self.seed_sequence)
+            )
+        return self._generator
+
+    def spawn(self, count):
+        return [self.__class__(s) for s in self.seed_sequence.spawn(count)]
+
+    def substream(self, *key):
+        # Keyed on the work item rather than on spawn order, like
+        # `Tournament.seed_for`; `substream(k)` is the k-th spawned stream
+        seed = self.seed_sequence
+        return self.__class__(
+            np.random.SeedSequence(
+                seed.entropy,
+                spawn_key=seed.spawn_key + key,
+            )
+        )
+
+
+#
+# Functions
+#
+
+
+def _unpickle_stream(seed_sequence, state, generator):
+    stream = RngStream(seed_sequence)
+    stream.setstate(state)
+    stream._generator = generator
+    return stream
+
+
+def as_generator(rng):
+    # A NumPy Generator for any RNG the rest of the code accepts: streams,
+    # Generators, seeds and SeedSequences, or a plain `random.Random`
+    if isinstance(rng, RngStream):
+        return rng.generator
+    if isinstance(rng, random.Random):
+        return np.random.default_rng(rng.getrandbits(64))
+    return np.random.default_rng(rng)
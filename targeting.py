@@ -0,0 +1,124 @@
+import heapq
+
+import numpy as np
+
+
+#
+# Policies
+#
+
+
+# A policy maps a candidate target to a priority; the highest priority living
+# enemy of the attacker is chosen, ties going to the earliest unit in
+# initiative order.  Priorities may depend on battle state such as
+# `absorbed_hits`; combat re-ranks a unit whenever a volley hits it.
+
+
+def missile_priority(target):
+    return (-target.stats["hull_tank"], target.num_missile_dice)
+
+
+def cannon_priority(target):
+    return (-target.stats["hull_tank"], target.num_cannon_dice)
+
+
+def most_dangerous_priority(target):
+    return (target.num_cannon_dice, -target.stats["hull_tank"])
+
+
+#
+# Classes
+#
+
+
+class TargetIndex:
+
+    def __init__(self, units, priority):
+        self.priority = priority
+        self._discarded = set()
+        # One heap per team, teamless units sharing one.  An attacker looks
+        # at the top of every heap but their own team's.  Entries are
+        # (negated priority, position, version, unit); re-ranking a unit
+        # pushes a new version and leaves the old entry to be pruned.
+        self._heaps = {}
+        self._entries = {}
+        for (i, u) in enumerate(units):
+            entry = (self._rank(u), i, 0, u)
+            self._entries[id(u)] = entry
+            self._heaps.setdefault(u.team, []).append(entry)
+        for heap in self._heaps.values():
+            heapq.heapify(heap)
+
+    def _rank(self, unit):
+        return tuple(-k for k in self.priority(unit))
+
+    def __len__(self):
+        return sum(
+            1 for (_, _, _, u) in self._entries.values()
+            if id(u) not in self._discarded and u.is_alive()
+        )
+
+    def discard(self, unit):
+        self._discarded.add(id(unit))
+
+    def update(self, unit):
+        # Re-ranks a unit whose priority may have changed
+        (rank, i, version, _) = self._entries[id(unit)]
+        new_rank = self._rank(unit)
+        if new_rank == rank:
+            return
+        entry = (new_rank, i, version + 1, unit)
+        self._entries[id(unit)] = entry
+        heapq.heappush(self._heaps[unit.team], entry)
+
+    def _prune(self, heap):
+        while heap:
+            unit = heap[0][3]
+            if (
+                id(unit) not in self._discarded
+                and unit.is_alive()
+                and heap[0] is self._entries[id(unit)]
+            ):
+                return
+            heapq.heappop(heap)
+
+    def _top(self, heap, attacker):
+        self._prune(heap)
+        if not heap:
+            return None
+        if heap[0][3] is not attacker:
+            return heap[0]
+
+        # The attacker can't target themselves; set them aside and look at
+        # the runner-up
+        held = heapq.heappop(heap)
+        self._prune(heap)
+        runner_up = heap[0] if heap else None
+        heapq.heappush(heap, held)
+        return runner_up
+
+    def select(self, attacker):
+        best = None
+        for (team, heap) in self._heaps.items():
+            if team is not None and team == attacker.team:
+                continue
+            entry = self._top(heap, attacker)
+            if entry is not None and (best is None or entry[:2] < best[:2]):
+                best = entry
+        return best[3] if best is not None else None
+
+
+#
+# Functions
+#
+
+
+def target_ranking(hull, pool_sizes, position=None):
+    # The default policies as an array of unit indices, most preferred
+    # first: smallest hull, then largest dice pool, then earliest in
+    # initiative order.  `position` gives each unit's place in initiative
+    # order, if that isn't the order they are listed in.
+    hull = np.asarray(hull)
+    if position is None:
+        position = np.arange(len(hull))
+    return np.lexsort((position, -np.asarray(pool_sizes), hull))
@@ -0,0 +1,123 @@
+from concurrent.futures import as_completed
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from batch import simulate
+from batch import simulate_until
+from cache import simulate_cached
+from initiative import Initiative
+
+
+#
+# Classes
+#
+
+
+class Tournament:
+
+    def __init__(
+        self,
+        units,
+        trials=1000,
+        seed=0,
+        max_workers=None,
+        cache=None,
+        width=None,
+    ):
+        self.units = list(units)
+        self.trials = trials
+        self.seed = seed
+        self.max_workers = max_workers
+        # Optional `cache.ResultCache`, shared with the workers by path
+        self.cache = cache
+        # With a width, each pairing stops once its win rates are pinned down
+        # that finely (or decided), and `trials` becomes the cap
+        self.width = width
+        # (i, j) with i < j -> (win rate of i, win rate of j, draw rate)
+        self.results = {}
+
+    def add_unit(self, unit):
+        self.units.append(unit)
+        return len(self.units) - 1
+
+    def pending(self):
+        n = len(self.units)
+        return [
+            (i, j) for i in range(n) for j in range(i + 1, n)
+            if (i, j) not in self.results
+        ]
+
+    def seed_for(self, i, j):
+        # Keyed on the pairing rather than on submission order, so results
+        # reproduce regardless of scheduling or which units were added later
+        return np.random.SeedSequence(self.seed, spawn_key=(i, j))
+
+    def run(self):
+        pending = self.pending()
+        if not pending:
+            return
+
+        with ProcessPoolExecutor(max_workers=self.max_workers) as pool:
+            futures = {
+                pool.submit(
+                    _play,
+                    self.units[i],
+                    self.units[j],
+                    self.trials,
+                    self.seed_for(i, j),
+                    self.cache,
+                    self.width,
+                ): (i, j)
+                for (i, j) in pending
+            }
+            for future in as_completed(futures):
+                (i, j) = futures[future]
+                self.results[(i, j)] = future.result()
+                yield (i, j, self.results[(i, j)])
+
+    def run_all(self):
+        for _ in self.run():
+            pass
+        return self.matrix()
+
+    def matrix(self):
+        n = len(self.units)
+        wins = np.full((n, n), np.nan)
+        for ((i, j), (win_i, win_j, _)) in self.results.items():
+            wins[i, j] = win_i
+            wins[j, i] = win_j
+        return wins
+
+    def draws(self):
+        n = len(self.units)
+        draws = np.full((n, n), np.nan)
+        for ((i, j), (_, _, draw)) in self.results.items():
+            draws[i, j] = draw
+            draws[j, i] = draw
+        return draws
+
+
+#
+# Functions
+#
+
+
+def _play(first, second, trials, seed, cache=None, width=None):
+    initiative = Initiative([first, second])
+    if width is not None:
+        result = simulate_until(
+            initiative,
+            width,
+            max_trials=trials,
+            rng=seed,
+            cache=cache,
+        )
+    elif cache is not None:
+        result = simulate_cached(initiative, trials, cache, seed)
+    else:
+        result = simulate(initiative, trials, seed)
+    rates = {
+        id(u): float(r) for (u, r) in zip(result.units, result.win_rates())
+    }
+    return (rates[id(first)], rates[id(second)], result.draw_rate())
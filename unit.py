@@ -1,12 +1,40 @@
+from array import array
 from dataclasses import asdict
 from dataclasses import dataclass
 from dataclasses import field
 from dataclasses import fields
 from dataclasses import MISSING
+from functools import lru_cache
+from operator import attrgetter
 
+import numpy as np
 from formal_vector import FormalVector
 
+from combat import DEFINITE
+from combat import HISTOGRAM_SIZE
+from combat import SELF_HITS
 from combat import Volley
+from combat import VolleyDistribution
+
+
+#
+# Constants
+#
+
+
+FACE_PROBABILITIES = [1/6]*6
+
+STAT_FIELDS = (
+    "targeting",
+    "mitigation",
+    "hull_tank",
+    "power",
+    "speed",
+    "initiative",
+    "power_cost",
+)
+
+_stat_values = attrgetter(*STAT_FIELDS)
 
 
 #
@@ -14,8 +42,90 @@ from combat import Volley
 #
 
 
-class Stats(FormalVector):
-    _ZERO = "Stats.zero()"
+class StatsVector(FormalVector):
+    _ZERO = "StatsVector.zero()"
+
+
+class Stats:
+
+    # Fixed fields rather than a FormalVector, so arithmetic and lookups
+    # don't allocate a dict per key.  Treat instances as immutable.
+    __slots__ = STAT_FIELDS
+
+    @classmethod
+    def zero(cls):
+        return cls()
+
+    @classmethod
+    def from_triples(cls, triples):
+        return cls(**{name: value for (name, value, _) in triples})
+
+    @classmethod
+    def from_formal(cls, vector):
+        return cls(*(vector[f] for f in STAT_FIELDS))
+
+    @classmethod
+    def sum(cls, stats):
+        return cls(*map(sum, zip(*map(_stat_values, stats))))
+
+    def __init__(
+        self,
+        targeting=0,
+        mitigation=0,
+        hull_tank=0,
+        power=0,
+        speed=0,
+        initiative=0,
+        power_cost=0,
+    ):
+        self.targeting = targeting
+        self.mitigation = mitigation
+        self.hull_tank = hull_tank
+        self.power = power
+        self.speed = speed
+        self.initiative = initiative
+        self.power_cost = power_cost
+
+    def __getitem__(self, name):
+        if name not in STAT_FIELDS:
+            raise KeyError(name)
+        return getattr(self, name)
+
+    def as_tuple(self):
+        return _stat_values(self)
+
+    def triples(self):
+        return [(f, getattr(self, f), None) for f in STAT_FIELDS]
+
+    def to_formal(self):
+        return StatsVector.from_triples(self.triples())
+
+    def __add__(self, other):
+        return self.__class__(
+            *(a + b for (a, b) in zip(_stat_values(self), _stat_values(other)))
+        )
+
+    def __sub__(self, other):
+        return self.__class__(
+            *(a - b for (a, b) in zip(_stat_values(self), _stat_values(other)))
+        )
+
+    def __mul__(self, scalar):
+        return self.__class__(*(scalar*a for a in _stat_values(self)))
+
+    __rmul__ = __mul__
+
+    def __neg__(self):
+        return -1*self
+
+    def __eq__(self, other):
+        if not isinstance(other, Stats):
+            return NotImplemented
+        return _stat_values(self) == _stat_values(other)
+
+    def __repr__(self):
+        fs = ", ".join(f"{f}={v}" for (f, v, _) in self.triples() if v)
+        return f"{self.__class__.__name__}({fs})"
 
 
 @dataclass(frozen=True)
@@ -24,6 +134,22 @@ class Die:
     def roll(self, rng):
         raise NotImplementedError()
 
+    def tally(self, rng, histogram):
+        raise NotImplementedError()
+
+    def distribution(self, shift):
+        raise NotImplementedError()
+
+    def face_histogram(self):
+        # Row f is the volley histogram contributed by rolling face f+1
+        raise NotImplementedError()
+
+    def roll_many(self, rng, count, size=None):
+        # Rolls `count` of this die as one multinomial draw over faces.
+        # `count` may be an array of pool sizes, e.g. one per trial.
+        faces = rng.multinomial(count, FACE_PROBABILITIES, size=size)
+        return faces @ self.face_histogram()
+
 
 @dataclass(frozen=True)
 class NormalDie(Die):
@@ -36,6 +162,28 @@ class NormalDie(Die):
             accuracy = None
         return {"accuracy": accuracy, "hits": self.hits}
 
+    def tally(self, rng, histogram):
+        accuracy = rng.choice([1, 2, 3, 4, 5, 6])
+        if accuracy == 6:
+            histogram[DEFINITE] += self.hits
+        else:
+            histogram[accuracy - 1] += self.hits
+
+    def distribution(self, shift):
+        # Accuracy 6 always hits; accuracies 1-5 hit once shifted to 5+
+        num_hitting = 1 + min(max(shift + 1, 0), 5)
+        p = num_hitting / 6
+        return (((self.hits, 0), p), ((0, 0), 1 - p))
+
+    @lru_cache
+    def face_histogram(self):
+        histogram = np.zeros((6, HISTOGRAM_SIZE), dtype=np.int64)
+        for accuracy in range(5):
+            histogram[accuracy, accuracy] = self.hits
+        histogram[5, DEFINITE] = self.hits
+        histogram.setflags(write=False)
+        return histogram
+
     def __repr__(self):
         return f"Die({self.hits})"
 
@@ -49,10 +197,84 @@ class RiftDie(Die):
         )
         return {"accuracy": None, "hits": hits, "self_hits": self_hits}
 
+    def tally(self, rng, histogram):
+        (hits, self_hits) = rng.choice(
+            [(1, 0), (2, 0), (3, 1), (0, 1), (0, 0), (0, 0)]
+        )
+        histogram[DEFINITE] += hits
+        histogram[SELF_HITS] += self_hits
+
+    def distribution(self, shift):
+        return (
+            ((1, 0), 1/6),
+            ((2, 0), 1/6),
+            ((3, 1), 1/6),
+            ((0, 1), 1/6),
+            ((0, 0), 2/6),
+        )
+
+    @lru_cache
+    def face_histogram(self):
+        histogram = np.zeros((6, HISTOGRAM_SIZE), dtype=np.int64)
+        histogram[:, DEFINITE] = [1, 2, 3, 0, 0, 0]
+        histogram[:, SELF_HITS] = [0, 0, 1, 1, 0, 0]
+        histogram.setflags(write=False)
+        return histogram
+
     def __repr__(self):
         return "Die(R)"
 
 
+def stats_array(stats):
+    # One row per Stats, columns in STAT_FIELDS order
+    return np.array([s.as_tuple() for s in stats], dtype=np.int64)
+
+
+def side_ids(teams):
+    # Numbers sides 0, 1, ... in order of first appearance.  Units without a
+    # team (None) are each a side of their own.
+    labels = {}
+    sides = []
+    num_sides = 0
+    for team in teams:
+        if team is not None and team in labels:
+            sides.append(labels[team])
+            continue
+        if team is not None:
+            labels[team] = num_sides
+        sides.append(num_sides)
+        num_sides += 1
+    return np.array(sides, dtype=np.int64)
+
+
+def _unpickle_module(cls, values):
+    return MODULES.intern(cls(*values))
+
+
+def _add_die(pool, die, count):
+    new_count = pool.get(die, 0) + count
+    if new_count:
+        pool[die] = new_count
+    else:
+        del pool[die]
+
+
+def roll_pool(rng, pool, size=None):
+    # Volley histograms for a pool of (die, count) pairs; identical dice are
+    # rolled together in a single draw
+    histograms = [die.roll_many(rng, count, size) for (die, count) in pool]
+    if not histograms:
+        shape = () if size is None else np.atleast_1d(size)
+        return np.zeros((*shape, HISTOGRAM_SIZE), dtype=np.int64)
+    return sum(histograms)
+
+
+def power_balance(modules):
+    # Power provided less power drawn; a loadout is feasible when this is
+    # non-negative
+    return sum(m.net_power() for m in modules)
+
+
 @dataclass(frozen=True)
 class Module:
 
@@ -66,19 +288,47 @@ class Module:
     initiative: int = 0
     power_cost: int = 0
 
-    def stats(self):
-        return Stats.from_triples(
-            [
-                ("targeting", self.targeting, None),
-                ("mitigation", self.mitigation, None),
-                ("hull_tank", self.hull_tank, None),
-                ("power", self.power, None),
-                ("speed", self.speed, None),
-                ("initiative", self.initiative, None),
-                ("power_cost", self.power_cost, None),
-            ]
+    def __post_init__(self):
+        # Dice are often given as lists; keep modules hashable
+        object.__setattr__(self, "missile_dice", tuple(self.missile_dice))
+        object.__setattr__(self, "cannon_dice", tuple(self.cannon_dice))
+        object.__setattr__(self, "_hash", hash(self._field_values()))
+        object.__setattr__(
+            self,
+            "_stats",
+            Stats(*(getattr(self, f) for f in STAT_FIELDS)),
         )
 
+    def _field_values(self):
+        return tuple(getattr(self, f.name) for f in fields(self))
+
+    def __hash__(self):
+        return self._hash
+
+    def __reduce__(self):
+        # The cached hash is only valid in this process, so rebuild (and
+        # intern) on unpickling rather than restoring it
+        return (_unpickle_module, (self.__class__, self._field_values()))
+
+    def canonical_key(self):
+        return (
+            repr(self.missile_dice),
+            repr(self.cannon_dice),
+            self.targeting,
+            self.mitigation,
+            self.hull_tank,
+            self.power,
+            self.speed,
+            self.initiative,
+            self.power_cost,
+        )
+
+    def stats(self):
+        return self._stats
+
+    def net_power(self):
+        return self.power - self.power_cost
+
     def __repr__(self):
         field_dict = asdict(self)
         non_defaults = [
@@ -98,70 +348,200 @@ class Module:
         return f"{self.__class__.__name__}({fs})"
 
 
+class ModuleRegistry:
+
+    def __init__(self):
+        self._ids = {}
+        self._modules = []
+
+    def __len__(self):
+        return len(self._modules)
+
+    def __getitem__(self, module_id):
+        return self._modules[module_id]
+
+    def id_of(self, module):
+        module_id = self._ids.get(module)
+        if module_id is None:
+            module_id = len(self._modules)
+            self._ids[module] = module_id
+            self._modules.append(module)
+        return module_id
+
+    def intern(self, module):
+        return self._modules[self.id_of(module)]
+
+
+MODULES = ModuleRegistry()
+
+
 class Unit:
 
-    def __init__(self, name, num_slots, modules=None):
+    def __init__(self, name, num_slots, modules=None, team=None):
         self.name = name
         self.num_slots = num_slots
+        # Units on the same team don't target each other; None is a
+        # free-for-all
+        self.team = team
         self.absorbed_hits = 0
-        self._modules = modules or []
-        if len(self._modules) > num_slots:
+        modules = modules or []
+        if len(modules) > num_slots:
             raise ValueError(
-                f"Number of modules ({len(self._modules)}) exceeds number of "
+                f"Number of modules ({len(modules)}) exceeds number of "
                 f"slots ({self.num_slots})"
             )
+        self._module_ids = array("I", [MODULES.id_of(m) for m in modules])
+        self._set_stats(self.stats_from_modules())
+        self._set_pools()
+
+    def __getstate__(self):
+        # Module IDs are local to this process's registry, so ship modules
+        state = dict(self.__dict__)
+        state["_module_ids"] = self.modules
+        return state
+
+    def __setstate__(self, state):
+        modules = state.pop("_module_ids")
+        self.__dict__.update(state)
+        self._module_ids = array("I", [MODULES.id_of(m) for m in modules])
 
     @property
     def modules(self):
-        return self._modules
+        return [MODULES[i] for i in self._module_ids]
+
+    @property
+    def module_ids(self):
+        return tuple(self._module_ids)
 
     @property
     def stats(self):
-        return self.stats_from_modules()
+        return self._stats
 
     @property
     def missile_dice(self):
-        return sum([m.missile_dice for m in self.modules], [])
+        if self._missile_dice is None:
+            self._missile_dice = tuple(
+                d for m in self.modules for d in m.missile_dice
+            )
+        return self._missile_dice
 
     @property
     def cannon_dice(self):
-        return sum([m.cannon_dice for m in self.modules], [])
+        if self._cannon_dice is None:
+            self._cannon_dice = tuple(
+                d for m in self.modules for d in m.cannon_dice
+            )
+        return self._cannon_dice
+
+    @property
+    def num_missile_dice(self):
+        return self._num_missile_dice
+
+    @property
+    def num_cannon_dice(self):
+        return self._num_cannon_dice
+
+    @property
+    def missile_pool(self):
+        return tuple(self._missile_pool.items())
+
+    @property
+    def cannon_pool(self):
+        return tuple(self._cannon_pool.items())
 
     def stats_from_modules(self):
         return Stats.sum(m.stats() for m in self.modules)
 
+    def signature(self):
+        # The loadout, independent of slot order and of the unit's name
+        return tuple(sorted(self.modules, key=Module.canonical_key))
+
+    def _set_stats(self, stats):
+        # Hot paths read these plain attributes rather than indexing stats
+        self._stats = stats
+        self._hull_tank = stats["hull_tank"]
+        self._targeting = stats["targeting"]
+        self._mitigation = stats["mitigation"]
+        self._power_budget = stats["power"] - stats["power_cost"]
+
+    def _set_pools(self):
+        # Dice are kept as (die -> count) multisets; the flat die tuples are
+        # only rebuilt if someone asks for them
+        self._missile_pool = {}
+        self._cannon_pool = {}
+        self._num_missile_dice = 0
+        self._num_cannon_dice = 0
+        self._missile_dice = None
+        self._cannon_dice = None
+        for m in self.modules:
+            self._update_pools(m, 1)
+
+    def _update_pools(self, module, sign):
+        for die in module.missile_dice:
+            _add_die(self._missile_pool, die, sign)
+        for die in module.cannon_dice:
+            _add_die(self._cannon_pool, die, sign)
+        self._num_missile_dice += sign*len(module.missile_dice)
+        self._num_cannon_dice += sign*len(module.cannon_dice)
+        if module.missile_dice:
+            self._missile_dice = None
+        if module.cannon_dice:
+            self._cannon_dice = None
+
     def is_alive(self):
-        return not self.is_dead()
+        return self.absorbed_hits <= self._hull_tank
 
     def is_dead(self):
-        return self.absorbed_hits > self.stats["hull_tank"]
+        return self.absorbed_hits > self._hull_tank
+
+    def is_enemy(self, other):
+        return other is not self and (
+            self.team is None or self.team != other.team
+        )
 
     def select_missile_target(self, targets):
         return max(
-            [t for t in targets if t is not self],
-            key=lambda t: (-t.stats["hull_tank"], len(t.missile_dice)),
+            [t for t in targets if self.is_enemy(t)],
+            key=lambda t: (-t._hull_tank, t._num_missile_dice),
         )
 
     def select_cannon_target(self, targets):
-        eligible = [t for t in targets if t is not self]
+        eligible = [t for t in targets if self.is_enemy(t)]
         if eligible:
             return max(
                 eligible,
-                key=lambda t: (-t.stats["hull_tank"], len(t.cannon_dice)),
+                key=lambda t: (-t._hull_tank, t._num_cannon_dice),
             )
         else:
             return None
 
-    def missile_volley(self, rng):
-        dice = self.missile_dice
-        return Volley.from_dice(rng, dice).add_accuracy(self.stats["targeting"])
+    def missile_volley(self, rng, record_rolls=True):
+        # Pools are only rolled in bulk by Generators.  Anything else rolls
+        # die by die in module order whether or not rolls are recorded, so
+        # a seed gives the same battle whatever is watching.
+        if record_rolls or not isinstance(rng, np.random.Generator):
+            volley = Volley.from_dice(rng, self.missile_dice, record_rolls)
+        else:
+            volley = Volley.from_pool(rng, self._missile_pool.items())
+        return volley.add_accuracy(self._targeting)
+
+    def cannon_volley(self, rng, record_rolls=True):
+        if record_rolls or not isinstance(rng, np.random.Generator):
+            volley = Volley.from_dice(rng, self.cannon_dice, record_rolls)
+        else:
+            volley = Volley.from_pool(rng, self._cannon_pool.items())
+        return volley.add_accuracy(self._targeting)
+
+    def missile_distribution(self):
+        pool = self._missile_pool.items()
+        return VolleyDistribution.from_pool(pool).add_accuracy(self._targeting)
 
-    def cannon_volley(self, rng):
-        dice = self.cannon_dice
-        return Volley.from_dice(rng, dice).add_accuracy(self.stats["targeting"])
+    def cannon_distribution(self):
+        pool = self._cannon_pool.items()
+        return VolleyDistribution.from_pool(pool).add_accuracy(self._targeting)
 
     def mitigate(self, volley):
-        return volley.add_accuracy(-self.stats["mitigation"])
+        return volley.add_accuracy(-self._mitigation)
 
     def mitigate_self_damage(self, volley):
         # TODO: Self-damage mitigation doesn't exist yet
@@ -169,12 +549,13 @@ class Unit:
 
     def absorb(self, damage):
         hits = damage.all_hits()
-        self.absorbed_hits += damage.all_hits()
+        self.absorbed_hits += hits
         return hits
 
     def absorb_self_damage(self, damage):
-        self.absorbed_hits += damage.self_hits()
-        return damage.self_hits()
+        self_hits = damage.self_hits()
+        self.absorbed_hits += self_hits
+        return self_hits
 
     def clear_hits(self):
         self.absorbed_hits = 0
@@ -184,17 +565,17 @@ class Unit:
         if slot >= self.num_slots:
             raise ValueError(f"Not a valid slot number: {slot}")
 
+        old_module = MODULES[self._module_ids[slot]]
         if (
-            (
-                self.stats["power"] - self.stats["power_cost"]
-                - self.modules[slot].power + self.modules[slot].power_cost
-                + module.power - module.power_cost
-            )
+            self._power_budget - old_module.net_power() + module.net_power()
             < 0
         ):
             raise ValueError(f"Module exceeds power budget: {module}")
 
-        self._modules[slot] = module
+        self._module_ids[slot] = MODULES.id_of(module)
+        self._set_stats(self._stats - old_module.stats() + module.stats())
+        self._update_pools(old_module, -1)
+        self._update_pools(module, 1)
 
     def __repr__(self):
         return f"<{self.name}>"
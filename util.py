@@ -1,9 +1,11 @@
-import random
 import string
 from uuid import uuid4
 
+from streams import RngStream
 
-def short_id(length=5):
+
+def short_id(length=5, rng=None):
+    rng = rng or RngStream()
     return "".join(
-        random.choices(string.ascii_letters + string.digits, k=length)
+        rng.choices(string.ascii_letters + string.digits, k=length)
     )
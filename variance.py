@@ -0,0 +1,155 @@
+from statistics import NormalDist
+
+import numpy as np
+
+from batch import tally_outcomes
+from combat import NullSink
+from combat import perform_combat
+from initiative import Initiative
+
+
+#
+# Classes
+#
+
+
+class CommonRandomStream:
+
+    # Dice faces keyed on (trial, unit, volley, die) rather than on the order
+    # things happen in, so two variants of a battle roll the same faces
+    # wherever their dice line up.  Units are keyed by their position in the
+    # list handed to `Initiative`, so a variant that changes the turn order
+    # still lines up.
+
+    def __init__(self, seed, trial, antithetic=False):
+        self.seed = seed
+        self.trial = trial
+        self.antithetic = antithetic
+
+    def volley_stream(self, unit, volley):
+        generator = np.random.default_rng(
+            np.random.SeedSequence(
+                self.seed,
+                spawn_key=(self.trial, unit, volley),
+            )
+        )
+        return _VolleyStream(generator, self.antithetic)
+
+
+class _VolleyStream:
+
+    # What `Die.roll` and `Die.tally` need from an RNG; the k-th call draws
+    # the k-th uniform, so dice are indexed by their place in the volley
+
+    def __init__(self, generator, antithetic):
+        self._generator = generator
+        self.antithetic = antithetic
+
+    def random(self):
+        u = self._generator.random()
+        return 1 - u if self.antithetic else u
+
+    def choice(self, seq):
+        # Antithetic draws mirror faces: k becomes len(seq) - 1 - k
+        return seq[min(int(self.random()*len(seq)), len(seq) - 1)]
+
+
+class Comparison:
+
+    def __init__(self, battles, wins_a, wins_b, differences, confidence):
+        self.battles = battles
+        self.wins_a = wins_a
+        self.wins_b = wins_b
+        # One paired sample per trial; with antithetic pairing each sample
+        # already averages a battle and its mirror
+        self.differences = differences
+        self.confidence = confidence
+
+    def win_rates(self):
+        return (self.wins_a / self.battles, self.wins_b / self.battles)
+
+    def difference(self):
+        return float(self.differences.mean())
+
+    def stderr(self):
+        n = len(self.differences)
+        return float(self.differences.std(ddof=1) / np.sqrt(n))
+
+    def independent_stderr(self):
+        # What two independent runs of the same size would have given
+        (p_a, p_b) = self.win_rates()
+        return float(
+            np.sqrt((p_a*(1 - p_a) + p_b*(1 - p_b)) / self.battles)
+        )
+
+    def interval(self):
+        z = NormalDist().inv_cdf((1 + self.confidence) / 2)
+        d = self.difference()
+        return (d - z*self.stderr(), d + z*self.stderr())
+
+    def __repr__(self):
+        (p_a, p_b) = self.win_rates()
+        (lo, hi) = self.interval()
+        return (
+            f"<Comparison battles={self.battles} a={p_a:.3f} b={p_b:.3f}"
+            f" diff={self.difference():+.3f}"
+            f" {self.confidence:.0%} CI=[{lo:+.3f}, {hi:+.3f}]>"
+        )
+
+
+#
+# Helpers
+#
+
+
+def _focus_wins(rng, initiative, focus):
+    units = initiative.units
+    start = [u.absorbed_hits for u in units]
+    perform_combat(rng, initiative, NullSink())
+    result = tally_outcomes(units, [u.is_alive() for u in units])
+    for (u, hits) in zip(units, start):
+        u.absorbed_hits = hits
+    return int(result.wins[focus])
+
+
+#
+# Main functions
+#
+
+
+def compare(
+    units_a,
+    units_b,
+    trials,
+    focus=0,
+    seed=0,
+    antithetic=False,
+    confidence=0.95,
+):
+    # Win rate of `units_a[focus]` minus that of `units_b[focus]`, with both
+    # variants fought on common random numbers.  The lists should line up
+    # unit for unit, differing only where the loadouts being compared do.
+    # With `antithetic`, each trial also fights both variants on mirrored
+    # faces, so there are twice as many battles.
+    initiative_a = Initiative(list(units_a))
+    initiative_b = Initiative(list(units_b))
+    streams = (False, True) if antithetic else (False,)
+
+    wins_a = wins_b = 0
+    differences = np.zeros(trials)
+    for t in range(trials):
+        for mirrored in streams:
+            rng = CommonRandomStream(seed, t, mirrored)
+            win_a = _focus_wins(rng, initiative_a, focus)
+            win_b = _focus_wins(rng, initiative_b, focus)
+            wins_a += win_a
+            wins_b += win_b
+            differences[t] += (win_a - win_b) / len(streams)
+
+    return Comparison(
+        trials*len(streams),
+        wins_a,
+        wins_b,
+        differences,
+        confidence,
+    )